@@ -1,16 +1,26 @@
-import requests
+import asyncio
+import aiohttp
 import json
+import orjson
 import os
 import time
 import logging
 import sys # For stdout handler
-from datetime import datetime # For ISO timestamps
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 
 # --- JSON Logging Setup ---
+@lru_cache(maxsize=4)
+def _utc_timestamp_prefix(epoch_second):
+    # Records arrive in bursts within the same second, so the formatted prefix is cached.
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(epoch_second))
+
 class JsonFormatter(logging.Formatter):
     def format(self, record):
         log_record = {
-            "timestamp": datetime.utcfromtimestamp(record.created).isoformat() + "Z",
+            "timestamp": f"{_utc_timestamp_prefix(int(record.created))}.{int(record.msecs):03d}Z",
             "level": record.levelname,
             "message": record.getMessage() if isinstance(record.msg, str) else None,
             "module": record.module,
@@ -31,7 +41,7 @@ class JsonFormatter(logging.Formatter):
              log_record['exception_text'] = record.exc_text
 
 
-        return json.dumps(log_record)
+        return orjson.dumps(log_record, default=str).decode()
 
 # Configure logger
 logger = logging.getLogger("OpenProjectOllamaSync")
@@ -41,6 +51,11 @@ handler.setFormatter(JsonFormatter())
 logger.addHandler(handler)
 logger.propagate = False # Prevent duplicate logs if root logger is also configured
 
+# Per-task lifecycle events go through a child logger with its own level (TASK_LOG_LEVEL),
+# so bulk runs can drop them while keeping project-level and summary logs. Call sites
+# check isEnabledFor first to skip building the log dicts when they would be dropped.
+task_logger = logger.getChild("tasks")
+
 # --- Helper function to convert string to boolean ---
 def str_to_bool(value):
     if isinstance(value, bool):
@@ -50,37 +65,195 @@ def str_to_bool(value):
     return value.lower() in ('true', '1', 't', 'y', 'yes')
 
 # --- Configuration ---
-OPENPROJECT_URL = os.getenv("OPENPROJECT_URL", "https://your-openproject-instance.com")
-API_TOKEN = os.getenv("OPENPROJECT_API_TOKEN", "fake-api-token")
+@dataclass
+class Config:
+    openproject_url: str
+    api_token: str
+    ollama_url: str
+    ollama_model: str
+    verify_ssl: bool
+    task_concurrency: int
+    ai_comment_cache_file: str
+    last_run_file: str
+    task_log_level: str
+    ollama_max_parallel: int
+    ollama_idle_timeout: int
+    task_updated_within_days: int | None = None
+
+def read_env_file(path):
+    """Parses KEY=VALUE lines from a .env file, ignoring blanks and comments."""
+    values = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#") and "=" in line:
+                key, value = line.split("=", 1)
+                values[key.strip()] = value.strip()
+    return values
+
+def _positive_int(env, key, default):
+    # Zero would create a semaphore nobody can acquire and hang the run silently.
+    value = int(env.get(key, default))
+    if value < 1:
+        raise ValueError(f"{key} must be at least 1, got {value}")
+    return value
+
+def load_config(env_file=".env"):
+    """Builds the Config from the environment, with values from env_file taking precedence."""
+    env = {**os.environ}
+    if os.path.exists(env_file):
+        logger.info({"event": "loading_env_file", "path": env_file})
+        try:
+            env.update(read_env_file(env_file))
+        except Exception as e:
+            logger.error({"event": "env_file_load_error", "error": str(e)}, exc_info=True)
+    return Config(
+        openproject_url=env.get("OPENPROJECT_URL", "https://your-openproject-instance.com"),
+        api_token=env.get("OPENPROJECT_API_TOKEN", "fake-api-token"),
+        ollama_url=env.get("OLLAMA_API_URL", "https://ollama-url.com/api/generate"),
+        ollama_model=env.get("OLLAMA_MODEL_NAME", "mistral"),
+        verify_ssl=str_to_bool(env.get("VERIFY_SSL", "True")),
+        task_concurrency=_positive_int(env, "TASK_CONCURRENCY", "8"),
+        ai_comment_cache_file=env.get("AI_COMMENT_CACHE_FILE", ".ai_comment_cache.json"),
+        last_run_file=env.get("LAST_RUN_FILE", ".last_run.json"),
+        task_log_level=env.get("TASK_LOG_LEVEL", "WARNING").upper(),
+        ollama_max_parallel=_positive_int(env, "OLLAMA_MAX_PARALLEL", "1"),
+        ollama_idle_timeout=int(env.get("OLLAMA_IDLE_TIMEOUT", "300")),
+        task_updated_within_days=int(env["TASK_UPDATED_WITHIN_DAYS"]) if env.get("TASK_UPDATED_WITHIN_DAYS") else None,
+    )
 
-OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "https://ollama-url.com/api/generate")
-OLLAMA_MODEL_NAME = os.getenv("OLLAMA_MODEL_NAME", "mistral")
-# Correctly initialize VERIFY_SSL as a boolean
-VERIFY_SSL = str_to_bool(os.getenv("VERIFY_SSL", "True"))
 OLLAMA_REQUEST_TIMEOUT = 1800 # 30 mins
+OLLAMA_CONNECT_TIMEOUT = 10
 
 AI_COMMENT_MARKER = "🤖 AI Generated Context:\n\n"
-LLM_PROMPT_TEMPLATE = """
-Task Subject: {subject}
-Task Description:
-{description}
+AI_COMMENT_CACHE_FLUSH_INTERVAL = 50
+
+# --- HTTP Sessions ---
+# Each run shares one pooled client session for OpenProject and one for Ollama, so
+# concurrent tasks reuse keep-alive connections instead of handshaking per call.
+OPENPROJECT_REQUEST_TIMEOUT = 30
+WORK_PACKAGE_PAGE_SIZE = 1000
+WORK_PACKAGE_ID_BATCH_SIZE = 100
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+RETRY_BACKOFF_FACTOR = 0.3
+
+def create_openproject_session(cfg):
+    return aiohttp.ClientSession(
+        auth=aiohttp.BasicAuth("apikey", cfg.api_token),
+        headers={'Content-Type': 'application/json'},
+        # Sized so every in-flight task has a connection ready without queueing.
+        connector=aiohttp.TCPConnector(limit=max(32, cfg.task_concurrency * 2), ssl=cfg.verify_ssl),
+        timeout=aiohttp.ClientTimeout(total=OPENPROJECT_REQUEST_TIMEOUT),
+    )
+
+def create_ollama_session(cfg):
+    return aiohttp.ClientSession(
+        # At most ollama_max_parallel generations are in flight, so that many
+        # keep-alive connections are reused for the whole run.
+        connector=aiohttp.TCPConnector(limit=cfg.ollama_max_parallel, ssl=cfg.verify_ssl),
+        # Responses are streamed, so a stuck generation is caught by the gap between
+        # chunks (sock_read) long before the overall cap is reached.
+        timeout=aiohttp.ClientTimeout(total=OLLAMA_REQUEST_TIMEOUT, sock_connect=OLLAMA_CONNECT_TIMEOUT, sock_read=cfg.ollama_idle_timeout),
+    )
+
+async def _http_error_details(response):
+    error_details = {"error_message": response.reason, "status_code": response.status}
+    try:
+        error_details["response_body"] = orjson.loads(await response.read())
+    except json.JSONDecodeError: # orjson.JSONDecodeError subclasses it
+        error_details["response_body"] = await response.text()
+    return error_details
+
+# --- Local State Files ---
+def load_json_state(path):
+    """Loads a JSON object from path, returning {} if it is missing, unreadable or not an object."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "rb") as f:
+            state = orjson.loads(f.read())
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning({"event": "state_file_load_failed", "path": path, "error": str(e)})
+        return {}
+    if not isinstance(state, dict):
+        logger.warning({"event": "state_file_load_failed", "path": path, "error": "expected a JSON object"})
+        return {}
+    return state
+
+def save_json_state(path, state):
+    """Atomically writes state to path as JSON. Returns True on success."""
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(state))
+        os.replace(tmp_path, path)
+        return True
+    except OSError as e:
+        logger.warning({"event": "state_file_save_failed", "path": path, "error": str(e)})
+        return False
+
+# --- AI Comment Cache ---
+class AiCommentCache:
+    """Remembers which task versions already carry an AI comment.
+
+    Maps task id -> the task's ``updatedAt`` when the marker was seen, so re-runs can
+    skip the activities request for tasks that have not changed since.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = load_json_state(path)
+        self.pending_writes = 0
+
+    def has_marker(self, task_id, updated_at):
+        return updated_at is not None and self.entries.get(str(task_id)) == updated_at
+
+    def mark(self, task_id, updated_at):
+        if updated_at is None:
+            return
+        self.entries[str(task_id)] = updated_at
+        self.pending_writes += 1
+        if self.pending_writes >= AI_COMMENT_CACHE_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.pending_writes and save_json_state(self.path, self.entries):
+            self.pending_writes = 0
+
+# --- Incremental Sync State ---
+# The last-run file holds {"projects": {project id: last run start time}, "retry_task_ids": [...]}.
+# The next run only fetches work packages updated since a project's time, plus the
+# listed tasks that reached Ollama last time but did not get a comment.
+# Run start times come from this machine's clock but are compared with OpenProject's
+# updatedAt, so they are moved back a little to tolerate clock skew.
+LAST_RUN_CLOCK_SKEW = timedelta(minutes=5)
+
+def parse_timestamp(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+# The prompt is stored as fragments around the subject and description and joined by
+# concatenation, so nothing is re-parsed per task.
+LLM_PROMPT_PREFIX = "\nTask Subject: "
+LLM_PROMPT_DESCRIPTION_HEADER = "\nTask Description:\n"
+LLM_PROMPT_SUFFIX = """
 
 Based *only* on the task subject and description above, provide additional context that would be helpful for understanding or starting this task.
 Consider potential ambiguities, key questions to ask, or immediate next steps.
 Keep the output concise, focused, and directly related to the provided information. Do not add any preamble like "Additional Context:".
 Provide only the helpful context itself.
 """
+# Long descriptions are cut to keep the prompt (and generation time) bounded.
+LLM_PROMPT_DESCRIPTION_MAX_CHARS = 4000
 
 # --- OpenProject API Functions ---
-def _openproject_api_request(method, endpoint_suffix, params=None, payload=None):
-    if not OPENPROJECT_URL or not API_TOKEN:
+async def _openproject_api_request(session, cfg, method, endpoint_suffix, params=None, payload=None):
+    if not cfg.openproject_url or not cfg.api_token:
         logger.error({"event": "config_error", "message": "OpenProject URL or API Token is not configured."})
         return None
 
-    auth = ('apikey', API_TOKEN)
-    full_url = f"{OPENPROJECT_URL}{endpoint_suffix}"
-    headers = {'Content-Type': 'application/json'}
-    
+    full_url = f"{cfg.openproject_url}{endpoint_suffix}"
+
     log_data = {
         "event": "openproject_api_request",
         "method": method.upper(),
@@ -89,44 +262,44 @@ def _openproject_api_request(method, endpoint_suffix, params=None, payload=None)
     }
     # logger.debug(log_data) # Use debug for potentially verbose data
 
+    if method.lower() not in ('get', 'patch', 'post'):
+        logger.error({"event": "unsupported_http_method", "method": method, "url": full_url})
+        return None
+
+    # Only GETs are retried; replaying a POST could create duplicate comments.
+    attempts = MAX_RETRIES + 1 if method.lower() == 'get' else 1
+    data = orjson.dumps(payload) if payload is not None else None
     try:
-        if method.lower() == 'get':
-            response = requests.get(full_url, auth=auth, params=params, headers=headers, timeout=30, verify=VERIFY_SSL)
-        elif method.lower() == 'patch':
-            response = requests.patch(full_url, auth=auth, json=payload, headers=headers, timeout=30, verify=VERIFY_SSL)
-        elif method.lower() == 'post':
-            response = requests.post(full_url, auth=auth, json=payload, headers=headers, timeout=30, verify=VERIFY_SSL)
-        else:
-            logger.error({"event": "unsupported_http_method", "method": method, "url": full_url})
-            return None
-            
-        response.raise_for_status() # Will raise an HTTPError for bad responses (4xx or 5xx)
-        
-        # For POST requests, a 201 (Created) is common. 204 (No Content) can also occur.
-        # If the request was successful and there's content, return it. Otherwise, return True for success.
-        if response.status_code == 204: # No Content
-            return True 
-        if response.content: # Check if there is content to decode
-            return response.json()
-        return True # Success, but no content or not JSON (e.g. 200 OK with no body)
-
-    except requests.exceptions.Timeout:
+        for attempt in range(attempts):
+            async with session.request(method.upper(), full_url, params=params, data=data) as response:
+                if response.status in RETRY_STATUSES and attempt < attempts - 1:
+                    await asyncio.sleep(RETRY_BACKOFF_FACTOR * (2 ** attempt))
+                    continue
+                if response.status >= 400:
+                    error_details = await _http_error_details(response)
+                    logger.error({"event": "openproject_api_request_error", "method": method.upper(), "url": full_url, "details": error_details}, exc_info=False) # Set exc_info=True for full traceback if needed
+                    return None
+
+                # For POST requests, a 201 (Created) is common. 204 (No Content) can also occur.
+                # If the request was successful and there's content, return it. Otherwise, return True for success.
+                if response.status == 204: # No Content
+                    return True
+                body = await response.read()
+                if body: # Check if there is content to decode
+                    return orjson.loads(body)
+                return True # Success, but no content or not JSON (e.g. 200 OK with no body)
+
+    except asyncio.TimeoutError:
         logger.error({"event": "openproject_api_timeout", "method": method.upper(), "url": full_url})
-    except requests.exceptions.RequestException as e:
+    except (aiohttp.ClientError, json.JSONDecodeError) as e:
         error_details = {"error_message": str(e)}
-        if hasattr(e, 'response') and e.response is not None:
-            error_details["status_code"] = e.response.status_code
-            try:
-                error_details["response_body"] = e.response.json()
-            except json.JSONDecodeError:
-                error_details["response_body"] = e.response.text
-        logger.error({"event": "openproject_api_request_error", "method": method.upper(), "url": full_url, "details": error_details}, exc_info=False) # Set exc_info=True for full traceback if needed
+        logger.error({"event": "openproject_api_request_error", "method": method.upper(), "url": full_url, "details": error_details}, exc_info=False)
     return None
 
-def get_all_accessible_projects():
+async def get_all_accessible_projects(session, cfg):
     logger.info({"event": "fetching_all_projects_started"})
-    params = {'pageSize': 500} 
-    data = _openproject_api_request('get', "/api/v3/projects", params=params)
+    params = {'pageSize': 500}
+    data = await _openproject_api_request(session, cfg, 'get', "/api/v3/projects", params=params)
     if data and '_embedded' in data and 'elements' in data['_embedded']:
         projects = data['_embedded']['elements']
         logger.info({"event": "fetching_all_projects_success", "project_count": len(projects)})
@@ -135,11 +308,17 @@ def get_all_accessible_projects():
         logger.warning({"event": "fetching_all_projects_failed", "message": "No projects found or error occurred."})
         return []
 
-def get_openproject_tasks_for_project(project_identifier_or_id, project_name):
-    log_context = {"project_identifier": project_identifier_or_id, "project_name": project_name}
-    logger.info({"event": "fetching_project_tasks_started", **log_context})
-    api_suffix = f"/api/v3/projects/{project_identifier_or_id}/work_packages"
-    
+async def get_all_work_packages(session, cfg, updated_since=None):
+    """Fetches the open work packages visible to the API token in one paginated query.
+
+    The collection only returns work packages of projects the token can see, so no
+    project filter is sent; callers group the result by ``_links.project.href``.
+
+    If updated_since (ISO 8601) is given, only work packages updated after it are returned.
+    Returns the list of work packages, or None if any page could not be fetched.
+    """
+    logger.info({"event": "fetching_work_packages_started"})
+
     # Add filter to get only open tasks.
     # The operator "o" usually represents open statuses in OpenProject.
     # If this doesn't work for your specific OpenProject setup,
@@ -149,70 +328,99 @@ def get_openproject_tasks_for_project(project_identifier_or_id, project_name):
     filters = [
         {"status": {"operator": "o"}}
     ]
+    filter_applied = "open_statuses"
+    # OpenProject keeps one filter per field, so the TASK_UPDATED_WITHIN_DAYS window and
+    # updated_since are folded into a single updatedAt filter using the later bound.
+    if cfg.task_updated_within_days:
+        window_start = (datetime.now(timezone.utc) - timedelta(days=cfg.task_updated_within_days)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        if not updated_since or parse_timestamp(window_start) > parse_timestamp(updated_since):
+            updated_since = window_start
+    if updated_since:
+        # "<>d" with an open upper bound matches work packages updated at or after the timestamp.
+        filters.append({"updatedAt": {"operator": "<>d", "values": [updated_since, ""]}})
+        filter_applied += f",updated_since_{updated_since}"
+    tasks = await _get_work_packages(session, cfg, filters)
+    if tasks is not None:
+        logger.info({"event": "fetching_work_packages_success", "task_count": len(tasks), "filter_applied": filter_applied})
+    return tasks
+
+async def get_work_packages_by_id(session, cfg, task_ids):
+    """Fetches the given work packages, if still open, batching ids to keep URLs short.
+
+    Returns the list of work packages, or None if any batch could not be fetched.
+    """
+    logger.info({"event": "fetching_retry_work_packages_started", "task_count": len(task_ids)})
+    tasks = []
+    for start in range(0, len(task_ids), WORK_PACKAGE_ID_BATCH_SIZE):
+        batch = task_ids[start:start + WORK_PACKAGE_ID_BATCH_SIZE]
+        filters = [
+            {"id": {"operator": "=", "values": [str(task_id) for task_id in batch]}},
+            {"status": {"operator": "o"}}
+        ]
+        batch_tasks = await _get_work_packages(session, cfg, filters)
+        if batch_tasks is None:
+            return None
+        tasks.extend(batch_tasks)
+    logger.info({"event": "fetching_retry_work_packages_success", "task_count": len(tasks)})
+    return tasks
+
+async def _get_work_packages(session, cfg, filters):
+    """Pages through /api/v3/work_packages with the given filters."""
     params = {
+        "pageSize": WORK_PACKAGE_PAGE_SIZE,
         "filters": json.dumps(filters)
     }
-    data = _openproject_api_request('get', api_suffix, params=params)
-
-    if data and '_embedded' in data and 'elements' in data['_embedded']:
-        tasks = data['_embedded']['elements']
-        logger.info({"event": "fetching_project_tasks_success", "task_count": len(tasks), "filter_applied": "open_statuses", **log_context})
-        return tasks
-    logger.warning({"event": "fetching_project_tasks_failed", "message": "No open tasks found or error.", "filter_applied": "open_statuses", **log_context})
-    return []
 
-def get_task_activities(task_id):
+    tasks = []
+    offset = 1 # OpenProject offsets are 1-based page numbers
+    while True:
+        data = await _openproject_api_request(session, cfg, 'get', "/api/v3/work_packages", params={**params, "offset": offset})
+        if not (data and '_embedded' in data and 'elements' in data['_embedded']):
+            logger.warning({"event": "fetching_work_packages_failed", "message": "Error fetching work packages.", "offset": offset})
+            return None
+        elements = data['_embedded']['elements']
+        tasks.extend(elements)
+        # The server may cap pageSize below what was requested, so page by what it returned.
+        page_size = data.get('pageSize') or WORK_PACKAGE_PAGE_SIZE
+        if not elements or offset * page_size >= data.get('total', 0):
+            break
+        offset += 1
+    return tasks
+
+async def get_task_activities(session, cfg, task_id):
+    # The activities collection is not paginated and ignores pageSize/sortBy/filters,
+    # so the full history is returned; has_ai_generated_comment scans it newest-first.
     # logger.debug({"event": "fetching_task_activities_started", "task_id": task_id}) # Can be noisy
     api_suffix = f"/api/v3/work_packages/{task_id}/activities"
-    data = _openproject_api_request('get', api_suffix)
+    data = await _openproject_api_request(session, cfg, 'get', api_suffix)
     if data and '_embedded' in data and 'elements' in data['_embedded']:
         return data['_embedded']['elements']
     return []
 
-def has_ai_generated_comment(task_id):
-    activities = get_task_activities(task_id)
-    if not activities:
-        return False
-    for activity in activities:
-        # Check if the activity itself is a comment and has the marker
-        # The structure for comments via activities might differ slightly.
-        # We need to look for details._type == "Comment" or similar if activities endpoint includes non-comment events.
-        # Assuming 'comment' field exists directly in the activity for comments.
-        comment_data = activity.get('comment', {}) # If comment is nested
-        if not isinstance(comment_data, dict) and activity.get("_type") == "WorkPackageComment": # Simpler structure for some activity types
-             comment_data = activity.get("comment", {})
-
-
-        # If the activity itself represents the comment text directly (less common)
-        # or if it's nested under a 'details' attribute for comments
-        details_comment_raw = None
-        if activity.get("_type") == "Comment" and 'comment' in activity: # Check common OpenProject activity structure
-            comment_data = activity['comment']
-
-
-        if isinstance(comment_data, dict):
-            comment_raw = comment_data.get('raw', '')
-            if comment_raw and comment_raw.startswith(AI_COMMENT_MARKER):
-                logger.info({"event": "existing_ai_comment_found", "task_id": task_id, "source": "comment_field"})
-                return True
-        
-        # Also check if the activity is a direct comment, not just an update with a comment field
-        # This part might need adjustment based on the exact structure of your activity entries.
-        # Often, activities are generic and the "comment" is a specific detail of an update.
-        # However, if posting to /activities creates a specific "comment" activity type:
-        if 'details' in activity and isinstance(activity['details'], list):
-            for detail in activity['details']:
-                if detail.get('type') == 'Comment' and isinstance(detail.get('raw'), str):
-                    if detail['raw'].startswith(AI_COMMENT_MARKER):
-                        logger.info({"event": "existing_ai_comment_found_in_activity_details", "task_id": task_id})
-                        return True
-
-
+def has_ai_generated_comment(activities):
+    """Returns True if any activity carries a comment starting with AI_COMMENT_MARKER.
+
+    OpenProject puts a comment's text in ``comment.raw``; some versions also list it
+    as a ``Comment`` entry under ``details``, so both are checked in a single pass.
+    Activities come oldest-first and the AI comment is usually among the latest, so
+    they are scanned newest-first to exit early.
+    """
+    marker = AI_COMMENT_MARKER
+    for activity in reversed(activities):
+        comment = activity.get('comment')
+        if isinstance(comment, dict) and (comment.get('raw') or '').startswith(marker):
+            return True
+        for detail in activity.get('details') or ():
+            if isinstance(detail, dict) and detail.get('type') == 'Comment':
+                raw = detail.get('raw')
+                if isinstance(raw, str) and raw.startswith(marker):
+                    return True
     return False
 
-def add_comment_to_openproject_task(task_id, comment_text):
+async def add_comment_to_openproject_task(session, cfg, task_id, comment_text):
     log_context = {"task_id": task_id}
-    logger.info({"event": "adding_comment_via_activities_started", **log_context})
+    if task_logger.isEnabledFor(logging.INFO):
+        task_logger.info({"event": "adding_comment_via_activities_started", **log_context})
     # Endpoint for posting comments as activities
     api_suffix = f"/api/v3/work_packages/{task_id}/activities"
     payload = {
@@ -220,184 +428,254 @@ def add_comment_to_openproject_task(task_id, comment_text):
         "comment": {"raw": comment_text}
     }
     # Using 'post' to create a new activity (comment)
-    success = _openproject_api_request('post', api_suffix, payload=payload)
-    
+    success = await _openproject_api_request(session, cfg, 'post', api_suffix, payload=payload)
+
     if success: # This will be True if the request returned 200/201/204 or a JSON body
-        logger.info({"event": "adding_comment_via_activities_success", **log_context})
+        if task_logger.isEnabledFor(logging.INFO):
+            task_logger.info({"event": "adding_comment_via_activities_success", **log_context})
         return True
     else: # This will be True if _openproject_api_request returned None (an error occurred)
         logger.error({"event": "adding_comment_via_activities_failed", **log_context})
         return False
 
 # --- Ollama LLM Function ---
-def get_context_from_ollama(task_id, subject, description):
+async def get_context_from_ollama(ollama_session, cfg, task_id, subject, description):
     log_context = {"task_id": task_id, "subject": subject[:50]+"..."} # Truncate subject for brevity
     if not subject and not description:
         logger.warning({"event": "ollama_skip_empty_input", **log_context})
         return None
 
-    prompt = LLM_PROMPT_TEMPLATE.format(subject=subject, description=description if description else "Not provided.")
+    description = description[:LLM_PROMPT_DESCRIPTION_MAX_CHARS] if description else "Not provided."
+    prompt = LLM_PROMPT_PREFIX + subject + LLM_PROMPT_DESCRIPTION_HEADER + description + LLM_PROMPT_SUFFIX
     payload = {
-        "model": OLLAMA_MODEL_NAME,
+        "model": cfg.ollama_model,
         "prompt": prompt,
-        "stream": False,
+        "stream": True,
         "options": {"temperature": 0.5, "num_predict": 200}
     }
-    
-    logger.info({"event": "ollama_query_started", "ollama_model": OLLAMA_MODEL_NAME, **log_context})
-    
+
+    if task_logger.isEnabledFor(logging.INFO):
+        task_logger.info({"event": "ollama_query_started", "ollama_model": cfg.ollama_model, **log_context})
+
+    line = b""
     try:
-        response = requests.post(OLLAMA_API_URL, json=payload, timeout=OLLAMA_REQUEST_TIMEOUT, verify=VERIFY_SSL)
-        response.raise_for_status()
-        response_data = response.json()
-        generated_context = response_data.get("response", "").strip()
-        
+        async with ollama_session.post(cfg.ollama_url, data=orjson.dumps(payload), headers={'Content-Type': 'application/json'}) as response:
+            if response.status >= 400:
+                error_details = await _http_error_details(response)
+                logger.error({"event": "ollama_query_request_error", "ollama_model": cfg.ollama_model, "details": error_details, **log_context}, exc_info=False)
+                return None
+            # Each line of the stream is a JSON object carrying the next chunk of the response.
+            parts = []
+            async for line in response.content:
+                line = line.strip()
+                if not line:
+                    continue
+                chunk = orjson.loads(line)
+                if chunk.get("error"):
+                    logger.error({"event": "ollama_query_request_error", "ollama_model": cfg.ollama_model, "details": {"error_message": chunk["error"]}, **log_context}, exc_info=False)
+                    return None
+                parts.append(chunk.get("response", ""))
+                if chunk.get("done"):
+                    break
+        generated_context = "".join(parts).strip()
+
         if generated_context:
-            logger.info({"event": "ollama_query_success", "ollama_model": OLLAMA_MODEL_NAME, **log_context})
+            if task_logger.isEnabledFor(logging.INFO):
+                task_logger.info({"event": "ollama_query_success", "ollama_model": cfg.ollama_model, **log_context})
             return generated_context
         else:
-            logger.warning({"event": "ollama_empty_response", "ollama_model": OLLAMA_MODEL_NAME, **log_context})
+            logger.warning({"event": "ollama_empty_response", "ollama_model": cfg.ollama_model, **log_context})
             return None
-    except requests.exceptions.Timeout:
-        logger.error({"event": "ollama_query_timeout", "ollama_model": OLLAMA_MODEL_NAME, **log_context})
-    except requests.exceptions.RequestException as e:
+    except asyncio.TimeoutError:
+        logger.error({"event": "ollama_query_timeout", "ollama_model": cfg.ollama_model, **log_context})
+    except aiohttp.ClientError as e:
         error_details = {"error_message": str(e)}
-        if hasattr(e, 'response') and e.response is not None:
-            error_details["status_code"] = e.response.status_code
-            try:
-                error_details["response_body"] = e.response.json()
-            except json.JSONDecodeError:
-                error_details["response_body"] = e.response.text
-        logger.error({"event": "ollama_query_request_error", "ollama_model": OLLAMA_MODEL_NAME, "details": error_details, **log_context}, exc_info=False)
+        logger.error({"event": "ollama_query_request_error", "ollama_model": cfg.ollama_model, "details": error_details, **log_context}, exc_info=False)
     except json.JSONDecodeError as e:
-        error_details = {"error_message": str(e), "response_text": response.text if 'response' in locals() else "N/A"}
-        logger.error({"event": "ollama_query_json_decode_error", "ollama_model": OLLAMA_MODEL_NAME, "details": error_details, **log_context}, exc_info=False)
+        error_details = {"error_message": str(e), "response_text": line.decode(errors="replace") or "N/A"}
+        logger.error({"event": "ollama_query_json_decode_error", "ollama_model": cfg.ollama_model, "details": error_details, **log_context}, exc_info=False)
     return None
 
 # --- Main Processing Logic ---
-def main():
-    logger.info({"event": "script_started", "script_version": "v4-json-logging-activities-comment", "verify_ssl_status": VERIFY_SSL})
+async def process_task(sem, ollama_sem, session, ollama_session, cfg, comment_cache, task, task_log_context):
+    """Runs the activities check -> Ollama -> comment pipeline for one task.
+
+    The OpenProject steps hold a slot of ``sem`` and the generation holds a slot of
+    ``ollama_sem``, never both, so other tasks' activity checks and comment POSTs keep
+    flowing while this task waits on Ollama.
+
+    Returns one of "skipped", "no_context", "comment_added" or "comment_failed".
+    """
+    task_id = task.get('id')
+    subject = task.get('subject', 'No Subject')
+    description_data = task.get('description', {})
+    description_raw = description_data.get('raw', '') if isinstance(description_data, dict) else ''
+    updated_at = task.get('updatedAt')
+    # lock_version = task.get('lockVersion') # No longer needed for adding comments via activities
+
+    async with sem:
+        if task_logger.isEnabledFor(logging.INFO):
+            task_logger.info({"event": "task_processing_started", **task_log_context})
+
+        if task_id is None: # Removed lock_version check as it's not used for new comment method
+            logger.warning({"event": "task_skipped_missing_data", "reason": "Missing Task ID", **task_log_context})
+            return "skipped"
+
+        if comment_cache.has_marker(task_id, updated_at):
+            if task_logger.isEnabledFor(logging.INFO):
+                task_logger.info({"event": "task_skipped_existing_ai_comment", "source": "cache", **task_log_context})
+            return "skipped"
+
+        activities = await get_task_activities(session, cfg, task_id)
+        if has_ai_generated_comment(activities):
+            comment_cache.mark(task_id, updated_at)
+            if task_logger.isEnabledFor(logging.INFO):
+                task_logger.info({"event": "task_skipped_existing_ai_comment", **task_log_context})
+            return "skipped"
+
+    async with ollama_sem:
+        context = await get_context_from_ollama(ollama_session, cfg, task_id, subject, description_raw)
+    if not context:
+        if task_logger.isEnabledFor(logging.INFO):
+            task_logger.info({"event": "task_no_context_generated", **task_log_context})
+        return "no_context"
+
+    full_comment_text = f"{AI_COMMENT_MARKER}{context}"
+    async with sem:
+        # Call updated function without lock_version
+        if await add_comment_to_openproject_task(session, cfg, task_id, full_comment_text):
+            return "comment_added"
+        return "comment_failed"
+
+async def process_project(sem, ollama_sem, session, ollama_session, cfg, comment_cache, tasks, project_log_context):
+    """Processes one project's tasks.
+
+    Returns its stats as a Counter and the ids of tasks that reached Ollama but did not
+    get a comment, so the next run can retry them.
+    """
+    logger.info({"event": "project_processing_started", **project_log_context})
+
+    if not tasks:
+        logger.info({"event": "project_processing_skipped_no_tasks", **project_log_context})
+        return Counter(), []
+
+    outcomes = await asyncio.gather(*[
+        process_task(sem, ollama_sem, session, ollama_session, cfg, comment_cache, task, {**project_log_context, "task_id": task.get('id'), "task_subject": task.get('subject', 'No Subject'), "task_index": task_index + 1, "total_tasks_in_project": len(tasks)})
+        for task_index, task in enumerate(tasks)
+    ])
+    comment_cache.flush()
+
+    stats = Counter(
+        tasks_fetched=len(tasks),
+        tasks_skipped=outcomes.count("skipped"),
+        tasks_processed_for_ai=len(outcomes) - outcomes.count("skipped"),
+        comments_added=outcomes.count("comment_added"),
+    )
+    logger.info({
+        "event": "project_processing_finished",
+        "tasks_in_project": len(tasks),
+        "tasks_processed_for_ai_in_project": stats["tasks_processed_for_ai"],
+        "comments_added_in_project": stats["comments_added"],
+        "tasks_skipped_in_project": stats["tasks_skipped"],
+        **project_log_context
+    })
+    failed_task_ids = [task.get('id') for task, outcome in zip(tasks, outcomes) if outcome in ("no_context", "comment_failed")]
+    return stats, failed_task_ids
+
+async def main(cfg):
+    task_logger.setLevel(cfg.task_log_level)
+    logger.info({"event": "script_started", "script_version": "v4-json-logging-activities-comment", "verify_ssl_status": cfg.verify_ssl})
 
     config_ok = True
-    if not OPENPROJECT_URL or OPENPROJECT_URL == "https://your-openproject-instance.com": # Basic check
+    if not cfg.openproject_url or cfg.openproject_url == "https://your-openproject-instance.com": # Basic check
         logger.critical({"event": "config_missing", "parameter": "OPENPROJECT_URL"})
         config_ok = False
-    if not API_TOKEN or API_TOKEN == "YOUR_OPENPROJECT_API_TOKEN": # Basic check
+    if not cfg.api_token or cfg.api_token == "YOUR_OPENPROJECT_API_TOKEN": # Basic check
         logger.critical({"event": "config_missing", "parameter": "OPENPROJECT_API_TOKEN"})
         config_ok = False
     if not config_ok:
         logger.info({"event": "script_aborted_due_to_config"})
         return
 
-    all_projects = get_all_accessible_projects()
-    if not all_projects:
-        logger.info({"event": "script_exiting_no_projects"})
-        return
-
-    total_tasks_fetched_overall = 0
-    total_tasks_processed_for_ai_overall = 0
-    total_comments_added_overall = 0
-    total_tasks_skipped_overall = 0
-    
-    logger.info({"event": "multi_project_processing_started", "total_projects_to_process": len(all_projects)})
-
-    for project_index, project in enumerate(all_projects):
-        project_id = project.get('id')
-        project_identifier = project.get('identifier') # Use identifier for fetching tasks
-        project_name = project.get('name', f"Unnamed Project (ID: {project_id})")
-        project_log_context = {"project_id_op": project_id, "project_identifier": project_identifier, "project_name": project_name, "project_index": project_index + 1, "total_projects": len(all_projects)}
-
-        logger.info({"event": "project_processing_started", **project_log_context})
-
-        # Pass project_identifier (which could be ID or string identifier)
-        tasks = get_openproject_tasks_for_project(project_identifier, project_name) 
-        
-        if not tasks:
-            logger.info({"event": "project_processing_skipped_no_tasks", **project_log_context})
-            continue
-        
-        total_tasks_fetched_overall += len(tasks)
-        project_tasks_processed_for_ai = 0
-        project_comments_added = 0
-        project_tasks_skipped = 0
-
-
-        for task_index, task in enumerate(tasks):
-            task_id = task.get('id')
-            subject = task.get('subject', 'No Subject')
-            description_data = task.get('description', {})
-            description_raw = description_data.get('raw', '') if isinstance(description_data, dict) else ''
-            # lock_version = task.get('lockVersion') # No longer needed for adding comments via activities
-
-            task_log_context = {**project_log_context, "task_id": task_id, "task_subject": subject, "task_index": task_index + 1, "total_tasks_in_project": len(tasks)}
-            logger.info({"event": "task_processing_started", **task_log_context})
-
-            if task_id is None: # Removed lock_version check as it's not used for new comment method
-                logger.warning({"event": "task_skipped_missing_data", "reason": "Missing Task ID", **task_log_context})
-                total_tasks_skipped_overall += 1 # Count this as skipped
-                project_tasks_skipped +=1
-                continue
-            
-            if has_ai_generated_comment(task_id):
-                total_tasks_skipped_overall += 1
-                project_tasks_skipped +=1
-                logger.info({"event": "task_skipped_existing_ai_comment", **task_log_context})
-                continue
-
-            context = get_context_from_ollama(task_id, subject, description_raw) 
-            total_tasks_processed_for_ai_overall += 1
-            project_tasks_processed_for_ai +=1
-            
-            if context:
-                full_comment_text = f"{AI_COMMENT_MARKER}{context}"
-                # Call updated function without lock_version
-                if add_comment_to_openproject_task(task_id, full_comment_text):
-                    total_comments_added_overall += 1
-                    project_comments_added +=1
-            else:
-                logger.info({"event": "task_no_context_generated", **task_log_context})
-            
-        logger.info({
-            "event": "project_processing_finished", 
-            "tasks_in_project": len(tasks),
-            "tasks_processed_for_ai_in_project": project_tasks_processed_for_ai,
-            "comments_added_in_project": project_comments_added,
-            "tasks_skipped_in_project": project_tasks_skipped,
-            **project_log_context
-        })
+    comment_cache = AiCommentCache(cfg.ai_comment_cache_file)
+    last_run = load_json_state(cfg.last_run_file)
+    projects_synced_at = last_run.get("projects")
+    if not isinstance(projects_synced_at, dict):
+        projects_synced_at = {}
+    retry_task_ids = [task_id for task_id in last_run.get("retry_task_ids") or [] if isinstance(task_id, int)]
+    run_started_at = (datetime.now(timezone.utc) - LAST_RUN_CLOCK_SKEW).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    async with create_openproject_session(cfg) as session, create_ollama_session(cfg) as ollama_session:
+        all_projects = await get_all_accessible_projects(session, cfg)
+        if not all_projects:
+            logger.info({"event": "script_exiting_no_projects"})
+            return
+
+        # Every project advances each run, so the timestamps normally match. The server-side
+        # filter takes one timestamp, so it uses the oldest (none while any project is new);
+        # each project's own timestamp is then applied below.
+        project_synced_at = [projects_synced_at.get(str(project.get('id'))) for project in all_projects]
+        updated_since = None if None in project_synced_at else min(project_synced_at, key=parse_timestamp)
+
+        all_tasks = await get_all_work_packages(session, cfg, updated_since=updated_since)
+        if all_tasks is None:
+            logger.info({"event": "script_exiting_work_packages_unavailable"})
+            return
+
+        # Tasks that failed last run are fetched by id; if that fails they stay queued.
+        retry_tasks = await get_work_packages_by_id(session, cfg, retry_task_ids) if retry_task_ids else []
+        pending_retry_ids = set() if retry_tasks is not None else set(retry_task_ids)
+
+        tasks_by_project_href = {}
+        for task in all_tasks:
+            project_href = task.get('_links', {}).get('project', {}).get('href')
+            tasks_by_project_href.setdefault(project_href, []).append(task)
+        retry_tasks_by_project_href = {}
+        for task in retry_tasks or []:
+            project_href = task.get('_links', {}).get('project', {}).get('href')
+            retry_tasks_by_project_href.setdefault(project_href, []).append(task)
+
+        logger.info({"event": "multi_project_processing_started", "total_projects_to_process": len(all_projects)})
+
+        # Projects and their tasks all run concurrently; one shared semaphore bounds how
+        # many tasks are talking to OpenProject at once.
+        sem = asyncio.Semaphore(cfg.task_concurrency)
+        # Ollama queues generations beyond its own parallelism without sending a byte, which
+        # would trip the streaming idle timeout, so excess requests wait here instead.
+        ollama_sem = asyncio.Semaphore(cfg.ollama_max_parallel)
+        project_runs = []
+        for project_index, project in enumerate(all_projects):
+            project_id = project.get('id')
+            project_name = project.get('name', f"Unnamed Project (ID: {project_id})")
+            project_log_context = {"project_id_op": project_id, "project_identifier": project.get('identifier'), "project_name": project_name, "project_index": project_index + 1, "total_projects": len(all_projects)}
+            project_href = project.get('_links', {}).get('self', {}).get('href')
+            tasks = tasks_by_project_href.get(project_href, [])
+            synced_at = projects_synced_at.get(str(project_id))
+            if synced_at and synced_at != updated_since:
+                tasks = [task for task in tasks if not task.get('updatedAt') or parse_timestamp(task['updatedAt']) >= parse_timestamp(synced_at)]
+            task_ids = {task.get('id') for task in tasks}
+            tasks += [task for task in retry_tasks_by_project_href.get(project_href, []) if task.get('id') not in task_ids]
+            project_runs.append(process_project(sem, ollama_sem, session, ollama_session, cfg, comment_cache, tasks, project_log_context))
+
+        project_results = await asyncio.gather(*project_runs)
+        totals = sum((stats for stats, _ in project_results), Counter())
+
+    # Every project moves forward; tasks that failed are retried by id next run instead
+    # of holding back the project's timestamp.
+    for project in all_projects:
+        projects_synced_at[str(project.get('id'))] = run_started_at
+    for _, failed_task_ids in project_results:
+        pending_retry_ids.update(failed_task_ids)
+    save_json_state(cfg.last_run_file, {"projects": projects_synced_at, "retry_task_ids": sorted(pending_retry_ids)})
 
     summary_stats = {
         "total_projects_processed": len(all_projects),
-        "total_tasks_fetched_overall": total_tasks_fetched_overall,
-        "total_tasks_skipped_overall_existing_comment_or_missing_data": total_tasks_skipped_overall,
-        "total_tasks_processed_for_ai_overall": total_tasks_processed_for_ai_overall,
-        "total_new_ai_comments_added_overall": total_comments_added_overall
+        "total_tasks_fetched_overall": totals["tasks_fetched"],
+        "total_tasks_skipped_overall_existing_comment_or_missing_data": totals["tasks_skipped"],
+        "total_tasks_processed_for_ai_overall": totals["tasks_processed_for_ai"],
+        "total_new_ai_comments_added_overall": totals["comments_added"]
     }
     logger.info({"event": "script_finished", "summary": summary_stats})
 
 if __name__ == "__main__":
-    # Load .env file if present
-    if os.path.exists(".env"):
-        logger.info({"event": "loading_env_file", "path": ".env"})
-        try:
-            with open(".env") as f:
-                for line_number, line in enumerate(f, 1):
-                    line = line.strip()
-                    if line and not line.startswith("#") and "=" in line:
-                        key, value = line.split("=", 1)
-                        key = key.strip() # Remove potential whitespace around key
-                        value = value.strip() # Remove potential whitespace around value
-                        os.environ[key] = value # Set environment variable
-                        # Update globals if they were initialized before .env was loaded
-                        if key == "OPENPROJECT_URL": OPENPROJECT_URL = value
-                        if key == "OPENPROJECT_API_TOKEN": API_TOKEN = value
-                        if key == "OLLAMA_API_URL": OLLAMA_API_URL = value
-                        if key == "OLLAMA_MODEL_NAME": OLLAMA_MODEL_NAME = value
-                        if key == "VERIFY_SSL": 
-                            VERIFY_SSL = str_to_bool(value) # Convert to bool when loading from .env
-        except Exception as e:
-            logger.error({"event": "env_file_load_error", "error": str(e)}, exc_info=True)
-    else: 
-        pass # VERIFY_SSL retains its value from initial os.getenv or is already correctly boolean
-
-    main()
\ No newline at end of file
+    asyncio.run(main(load_config()))